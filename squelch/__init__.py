@@ -1,20 +1,18 @@
 __version__ = '0.3.1'
 
 import sys
+import os
 import logging
 from pathlib import Path
-import atexit
 import traceback
 import re
+import functools
+import bisect
 import json
-import readline
-import pydoc
 import shutil
 import warnings
+from types import MappingProxyType
 
-from sqlalchemy import create_engine, MetaData, Table, inspect
-from sqlalchemy.sql import text
-from sqlalchemy.exc import DatabaseError, NoSuchTableError
 from tabulate import tabulate, simple_separated_format
 
 PROGNAME = __name__
@@ -22,12 +20,16 @@ PROGNAME = __name__
 DEF_TABLE_FORMAT = 'presto'
 DEF_CONF_FILE = './squelch.json'
 DEF_HISTORY_FILE = Path('~/.squelch_history').expanduser()
+DEF_HISTORY_LENGTH = 1000
 DEF_CONF = {}
-DEF_STATE = {'pager': True, 'footer': True, 'format': DEF_TABLE_FORMAT, 'AUTOCOMMIT': True}
+DEF_STATE = {'pager': True, 'footer': True, 'format': DEF_TABLE_FORMAT, 'AUTOCOMMIT': True, 'FETCH_COUNT': 0}
 DEF_MIN_FOOTER = '\n'             # Blank line to separate table from prompt
+DEF_PAGER = 'less'
+DEF_PAGER_LESS_OPTS = '-FRX'      # Don't page output that fits the terminal
 
 URL_CRED_PATTERN = r'://(.+)@'
 URL_CRED_REPLACE = r'://***@'
+URL_CRED_RE = re.compile(URL_CRED_PATTERN)
 
 SQL_COMPLETIONS = ['select', 'insert', 'update', 'delete', 'create', 'drop', 'from', 'where', 'and', 'or', 'not', 'like', 'order by', 'group by', 'into', 'values','begin', 'transaction', 'commit', 'rollback']
 
@@ -36,8 +38,80 @@ DEF_REL_TYPES = ['table', 'view', 'sequence']
 TABLE_FORMAT_ALIASES = {'aligned': DEF_TABLE_FORMAT, 'unaligned': simple_separated_format('|'), 'csv': simple_separated_format(',')}
 UNALIGNED_TABLE_FORMATS = ['unaligned', 'csv']
 
+WELCOME_TEXT = fr"""{PROGNAME} ({__version__})
+Type "help" for help.
+"""
+
+HELP_SUMMARY_TEXT = fr"""You are using {PROGNAME}, a CLI to SQLAlchemy-supported database engines.
+Type:  \copyright for distribution terms
+       \? for help with {PROGNAME} commands
+       \q to quit"""
+
+HELP_REPL_CMD_TEXT = fr"""General
+  \copyright             show {PROGNAME} usage and distribution terms
+  \q                     quit {PROGNAME}
+
+Help
+  \?                     show help on backslash commands
+
+Informational
+  \d                     list tables, views, and sequences
+  \d      NAME           describe table or view
+  \di     [NAME]         list indexes
+  \ds     [NAME]         list sequences
+  \dt     [NAME]         list tables
+  \dv     [NAME]         list views
+
+Formatting
+  \pset [NAME [VALUE]]   set table output option
+                         (pager)
+
+Variables
+  \set [NAME [VALUE]]    set internal variable, or list all if no parameters
+"""
+
+DIST_TERMS_TEXT = f"""{PROGNAME} ({__version__}) distributed under Apache-2.0 license: https://spdx.org/licenses/Apache-2.0.html"""
+
+HELP_TEXTS = {r'help': HELP_SUMMARY_TEXT, r'\?': HELP_REPL_CMD_TEXT}
+
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=32)
+def _compile_pattern(pattern):
+    """
+    Compile the given regular expression pattern
+
+    The compiled pattern is cached, so that configurable patterns used on
+    every query are only compiled once per unique pattern string
+
+    :param pattern: The regular expression pattern
+    :type pattern: str
+    :returns: The compiled regular expression
+    :rtype: re.Pattern
+    """
+
+    return re.compile(pattern)
+
+@functools.lru_cache(maxsize=128)
+def _get_text_clause(raw):
+    """
+    Get the prepared query for the given raw query
+
+    The prepared query is cached, so that a query that is run repeatedly
+    (e.g. with different query parameter values) is only parsed once.  This
+    is safe as text clauses are immutable and their parameters are bound at
+    execution
+
+    :param raw: The raw query
+    :type raw: str
+    :returns: The prepared query
+    :rtype: sqlalchemy.sql.text
+    """
+
+    from sqlalchemy.sql import text
+
+    return text(raw)
+
 class Squelch(object):
     """
     Class providing a Simple SQL REPL Command Handler
@@ -46,20 +120,42 @@ class Squelch(object):
     DEFAULTS = {
         'conf_file': DEF_CONF_FILE,
         'history_file': DEF_HISTORY_FILE,
+        'history_length': DEF_HISTORY_LENGTH,
         'query_quoted_string_pattern': r"'[^']+'",
         'query_params_pattern': r':([a-z0-9_.]+)',
+        # Text that every query parameter placeholder contains.  Queries
+        # without it aren't scanned for parameters.  This only applies to the
+        # default query_params_pattern: if that is overridden without also
+        # setting a marker, then every query is scanned
+        'query_params_marker': ':',
         'repl_commands': {
-            'quit': [r'\q'],
-            'state': [r'\set', r'\pset'],
-            'metadata': [r'\d', r'\dt', r'\dv', r'\ds', r'\di'],
-            'help': [r'help', r'\?'],
-            'dist': [r'\copyright']
+            'quit': frozenset([r'\q']),
+            'state': frozenset([r'\set', r'\pset']),
+            'metadata': frozenset([r'\d', r'\dt', r'\dv', r'\ds', r'\di']),
+            'help': frozenset([r'help', r'\?']),
+            'dist': frozenset([r'\copyright'])
         },
-        'table_opts': {
+        # Read-only, so that set_table_opts() can't update the defaults in
+        # place for every instance
+        'table_opts': MappingProxyType({
             # Unfortunately, tabulate doesn't recognise a sqlalchemy result
             # as having keys(), so we can't set 'headers': 'keys' here
             'tablefmt': DEF_TABLE_FORMAT, 'showindex': False, 'disable_numparse': True
-        }
+        })
+    }
+
+    # Maps a (command, variable) pair to the state variable it sets, and a
+    # boolean value token to its value
+    _STATE_DISPATCH = {
+        (r'\pset', 'pager'): 'pager',
+        (r'\pset', 'footer'): 'footer',
+        (r'\pset', 'format'): 'format',
+        (r'\set', 'autocommit'): 'AUTOCOMMIT',
+        (r'\set', 'fetch_count'): 'FETCH_COUNT'
+    }
+    _STATE_VALUES = {
+        'off': False, 'false': False, '0': False, 'no': False,
+        'on': True, 'true': True, '1': True, 'yes': True
     }
  
     def __init__(self, conf=DEF_CONF, state=DEF_STATE):
@@ -78,7 +174,77 @@ class Squelch(object):
         self.query = None
         self.params = {}
         self.result = None
-        self.completions = SQL_COMPLETIONS
+        self.completions = sorted(SQL_COMPLETIONS)
+        self._completion_range = (None, 0, 0)
+
+    @property
+    def conf(self):
+        """
+        The program's configuration
+
+        Assigning a new configuration rebuilds the effective configuration
+        derived from it.  Note that changes made to the configuration
+        in-place are not seen by the effective configuration, so the
+        configuration should be reassigned instead
+
+        :returns: The program's configuration
+        :rtype: dict
+        """
+
+        return self._conf
+
+    @conf.setter
+    def conf(self, conf):
+        self._conf = conf
+        self._rebuild_effective_conf()
+
+    def _rebuild_effective_conf(self):
+        """
+        Rebuild the effective configuration
+
+        Configuration items that are consulted for every input, such as the
+        REPL commands and the query parameter patterns, are resolved against
+        self.DEFAULTS once, here, rather than on every input
+        """
+
+        # Any REPL commands in the configuration are aliases, added to the
+        # default commands
+        conf_cmds = self.conf.get('repl_commands', {})
+        default_cmds = self.DEFAULTS['repl_commands']
+        self._quit_cmds = default_cmds['quit'] | frozenset(conf_cmds.get('quit', ()))
+        self._state_cmds = default_cmds['state'] | frozenset(conf_cmds.get('state', ()))
+        self._metadata_cmds = default_cmds['metadata'] | frozenset(conf_cmds.get('metadata', ()))
+        self._help_cmds = default_cmds['help'] | frozenset(conf_cmds.get('help', ()))
+        self._dist_cmds = default_cmds['dist'] | frozenset(conf_cmds.get('dist', ()))
+
+        # Quoted strings and query parameters are matched as alternatives in
+        # a single scan, so that parameter-like text within a quoted string
+        # is consumed by the string and never seen as a parameter.  The
+        # parameter name is the first group of the parameters pattern or, if
+        # it has no groups, the whole match
+        self._query_quoted_string_re = _compile_pattern(self.get_conf_item('query_quoted_string_pattern'))
+        self._query_params_re = _compile_pattern(self.get_conf_item('query_params_pattern'))
+        params_pattern = self._query_params_re.pattern
+
+        if self._query_params_re.groups == 0:
+            params_pattern = f"({params_pattern})"
+
+        # Patterns with inline global flags, such as (?i), can't be combined,
+        # as the flags must start the expression.  These are applied in two
+        # passes instead
+        try:
+            self._query_scan_re = _compile_pattern(f"(?:{self._query_quoted_string_re.pattern})|(?:{params_pattern})")
+        except re.error as e:
+            logger.debug("scanning query parameters in two passes: %s", e)
+            self._query_scan_re = None
+
+        self._query_param_group = self._query_quoted_string_re.groups + 1
+
+        # The default marker only matches the default parameters pattern
+        if 'query_params_marker' in self.conf or 'query_params_pattern' not in self.conf:
+            self._query_params_marker = self.get_conf_item('query_params_marker')
+        else:
+            self._query_params_marker = ''
 
     def get_conf(self, file=DEF_CONF_FILE):
         """
@@ -103,7 +269,7 @@ class Squelch(object):
         path = Path(file)
 
         if path.is_file():
-            logger.info(f"reading configuration from file {file}")
+            logger.info("reading configuration from file %s", file)
 
             with path.open() as fp:
                 self.conf = json.load(fp)
@@ -114,11 +280,11 @@ class Squelch(object):
                     tmp = self.conf.copy()
 
                     try:
-                        tmp['url'] = re.sub(URL_CRED_PATTERN, URL_CRED_REPLACE, tmp['url'])
+                        tmp['url'] = URL_CRED_RE.sub(URL_CRED_REPLACE, tmp['url'])
                     except KeyError:
                         pass
 
-                    logger.debug(f"configuration read from file: {tmp}")
+                    logger.debug("configuration read from file: %s", tmp)
 
         return self.conf
 
@@ -155,7 +321,7 @@ class Squelch(object):
 
         # Ensure we update table_opts from self.conf and not self.DEFAULTS
         if 'table_opts' not in self.conf:
-            self.conf['table_opts'] = self.DEFAULTS['table_opts'].copy()
+            self.conf['table_opts'] = dict(self.DEFAULTS['table_opts'])
 
         # Handle some specific table format cases
         if 'tablefmt' in opts:
@@ -186,36 +352,30 @@ class Squelch(object):
         """
 
         state_text = ''
-        falsy = r'(off|false|0|no)'
-        truthy = r'(on|true|1|yes)'
 
         # Irrespective of the actual case of the state variable, we always
         # compare case-insensitively for ease of the user.  No two state
         # variable names should only differ by case, so this is quite safe
-        if cmd.lower().startswith(r'\pset pager'):
-            if re.match(fr'\\pset\s+pager\s+{falsy}', cmd.lower()):
-                self.state['pager'] = False
-                state_text = 'Pager usage is off.'
-            elif re.match(fr'\\pset\s+pager\s+{truthy}', cmd.lower()):
-                self.state['pager'] = True
-                state_text = 'Pager is used for long output.'
-        elif cmd.lower().startswith(r'\pset footer'):
-            if re.match(fr'\\pset\s+footer\s+{falsy}', cmd.lower()):
-                self.state['footer'] = False
-            elif re.match(fr'\\pset\s+footer\s+{truthy}', cmd.lower()):
-                self.state['footer'] = True
-        elif cmd.lower().startswith(r'\pset format'):
-            m = re.match(fr'\\pset\s+format\s+(.+)', cmd.lower())
-
-            if m:
-                fmt = m.groups()[0]
-                self.state['format'] = fmt
-                self.set_table_opts(tablefmt=fmt)
-        elif cmd.lower().startswith(r'\set autocommit'):
-            if re.match(fr'\\set\s+autocommit\s+{falsy}', cmd.lower()):
-                self.state['AUTOCOMMIT'] = False
-            elif re.match(fr'\\set\s+autocommit\s+{truthy}', cmd.lower()):
-                self.state['AUTOCOMMIT'] = True
+        parts = cmd.lower().split(maxsplit=2)
+
+        if len(parts) == 3:
+            key = self._STATE_DISPATCH.get((parts[0], parts[1]))
+            value = parts[2]
+
+            if key == 'format':
+                self.state[key] = value
+                self.set_table_opts(tablefmt=value)
+            elif key == 'FETCH_COUNT':
+                if value.isdecimal():
+                    self.state[key] = int(value)
+            elif key:
+                flag = self._STATE_VALUES.get(value)
+
+                if flag is not None:
+                    self.state[key] = flag
+
+                    if key == 'pager':
+                        state_text = 'Pager is used for long output.' if flag else 'Pager usage is off.'
 
         return state_text
 
@@ -230,11 +390,7 @@ class Squelch(object):
         :rtype: str
         """
 
-        text = fr"""{PROGNAME} ({__version__})
-Type "help" for help.
-"""
-
-        return text
+        return WELCOME_TEXT
 
     def get_help_summary_text(self):
         """
@@ -250,12 +406,7 @@ Type "help" for help.
         :rtype: str
         """
 
-        text = fr"""You are using {PROGNAME}, a CLI to SQLAlchemy-supported database engines.
-Type:  \copyright for distribution terms
-       \? for help with {PROGNAME} commands
-       \q to quit"""
-
-        return text
+        return HELP_SUMMARY_TEXT
 
     def get_help_repl_cmd_text(self):
         """
@@ -265,30 +416,7 @@ Type:  \copyright for distribution terms
         :rtype: str
         """
 
-        text = fr"""General
-  \copyright             show {PROGNAME} usage and distribution terms
-  \q                     quit {PROGNAME}
-
-Help
-  \?                     show help on backslash commands
-
-Informational
-  \d                     list tables, views, and sequences
-  \d      NAME           describe table or view
-  \di     [NAME]         list indexes
-  \ds     [NAME]         list sequences
-  \dt     [NAME]         list tables
-  \dv     [NAME]         list views
-
-Formatting
-  \pset [NAME [VALUE]]   set table output option
-                         (pager)
-
-Variables
-  \set [NAME [VALUE]]    set internal variable, or list all if no parameters
-"""
-
-        return text
+        return HELP_REPL_CMD_TEXT
 
     def get_help(self, cmd):
         r"""
@@ -303,14 +431,7 @@ Variables
         :rtype: str
         """
 
-        text = ''
-
-        if cmd.lower() == r'help':
-            text = self.get_help_summary_text()
-        elif cmd.lower() == r'\?':
-            text = self.get_help_repl_cmd_text()
-
-        return text
+        return HELP_TEXTS.get(cmd.lower(), '')
 
     def get_dist_terms_text(self):
         """
@@ -320,9 +441,7 @@ Variables
         :rtype: str
         """
 
-        text = f"""{PROGNAME} ({__version__}) distributed under Apache-2.0 license: https://spdx.org/licenses/Apache-2.0.html"""
-
-        return text
+        return DIST_TERMS_TEXT
 
     def connect(self, url):
         """
@@ -334,9 +453,11 @@ Variables
         :rtype: sqlalchemy.engine.Connection
         """
 
+        from sqlalchemy import create_engine
+
         engine = create_engine(url)
         self.conn = engine.connect()
-        logger.info(f"connected to database {self.conn.engine.url.database}")
+        logger.info("connected to database %s", self.conn.engine.url.database)
 
         return self.conn
 
@@ -352,10 +473,12 @@ Variables
         :type query: sqlalchemy.sql.text
         :param params: Optional query parameters to bind in the query
         :type params: dict
-        :returns: The query result set
-        :rtype: sqlalchemy.engine.CursorResult
+        :returns: The query result set, or None if the query failed
+        :rtype: sqlalchemy.engine.CursorResult or None
         """
 
+        from sqlalchemy.exc import DatabaseError
+
         self.result = None
 
         try:
@@ -395,9 +518,16 @@ Variables
             ts = shutil.get_terminal_size()
             nlines = data.count(sep)
 
+            # We find the sampled line lengths from the separator positions,
+            # rather than splitting, as splitting would copy the rest of data
             if nsample != -1 and nlines >= nsample:
-                sample_lines = data.split(sep, maxsplit=nsample)
-                ncolumns = max([len(i) for i in sample_lines[0:nsample]])
+                ncolumns = 0
+                start = 0
+
+                for _ in range(nsample):
+                    end = data.find(sep, start)
+                    ncolumns = max(ncolumns, end - start)
+                    start = end + len(sep)
             else:
                 ncolumns = data.find(sep)
 
@@ -420,10 +550,81 @@ Variables
         """
 
         if self.use_pager(data):
+            import pydoc
+
             pydoc.pager(data)
         else:
             print(data)
 
+    def open_pager(self):
+        """
+        Open the system pager as a subprocess to stream output to
+
+        The pager is chosen as for pydoc: it's taken from the MANPAGER or
+        PAGER environment variables, falling back to less, unless the
+        terminal is dumb.  If the LESS environment variable isn't set, then
+        less is configured not to page output that fits in the terminal
+
+        :returns: The pager process, with its stdin open for writing, or None
+        if no pager is available
+        :rtype: subprocess.Popen or None
+        """
+
+        import subprocess
+        import shlex
+
+        cmd = os.environ.get('MANPAGER') or os.environ.get('PAGER')
+
+        if not cmd:
+            if os.environ.get('TERM') in ('dumb', 'emacs'):
+                return None
+
+            cmd = DEF_PAGER
+
+        # The pager is run by the shell, which would only report a missing
+        # pager command once we'd started writing to it
+        try:
+            found = shutil.which(shlex.split(cmd)[0])
+        except (ValueError, IndexError):
+            found = None
+
+        if not found:
+            logger.debug("pager %s not found", cmd)
+            return None
+
+        env = os.environ.copy()
+        env.setdefault('LESS', DEF_PAGER_LESS_OPTS)
+
+        try:
+            return subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, text=True, errors='backslashreplace', env=env)
+        except OSError as e:
+            logger.debug("failed to open pager %s: %s", cmd, e)
+            return None
+
+    def close_pager(self, pager):
+        """
+        Close the given pager process's input and wait for it to exit
+
+        Keyboard interrupts are ignored while waiting, as the pager itself
+        handles them, and it's in control of the terminal until it exits
+
+        :param pager: The pager process, as returned by open_pager()
+        :type pager: subprocess.Popen
+        :returns: The pager's exit status
+        :rtype: int
+        """
+
+        try:
+            pager.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        while True:
+            try:
+                return pager.wait()
+            except KeyboardInterrupt:
+                pass
+
     def get_table_footer_text(self, nrows):
         """
         Get the text for a table footer
@@ -449,7 +650,7 @@ Variables
 
         return footer
 
-    def get_result_table_footer(self, table, table_opts):
+    def get_result_table_footer(self, result, nrows=-1):
         """
         Get the result table footer
 
@@ -458,35 +659,28 @@ Variables
         * Access to the row count is dependent on the DB engine supporting
           this.  It should be supported for UPDATE and DELETE, but may not
           be supported for INSERT or SELECT.
-        * If row count isn't supported by the DB engine, then a fallback is
-          to employ a heuristic to calculate the number of rows based on the
-          number of newlines found in the table.  Whilst this works for the
-          default `tablefmt` table option, it won't work for `tablefmt`
-          styles that have more or less table grid lines.
-
-        :param table: The result table text
-        :type table: str
-        :param table_opts: Options for rendering the tabulated result output
-        :type table_opts: dict
+        * If row count isn't supported by the DB engine, then the fallback is
+          the number of rows that were fetched from the result set into the
+          table, as given by nrows.
+
+        :param result: The query result set that the table was rendered from
+        :type result: sqlalchemy.engine.CursorResult
+        :param nrows: The number of rows fetched into the table.  If
+        nrows == -1, then the number of rows fetched isn't known
+        :type nrows: int
         :returns: The result table footer text
         :rtype: str
         """
 
-        nrows = -1
+        rowcount = result.rowcount
 
-        if self.result.supports_sane_rowcount and self.result.rowcount != -1:
-            logger.debug(f"row count available in the result cursor")
-            nrows = self.result.rowcount
+        if result.supports_sane_rowcount and rowcount != -1:
+            logger.debug("row count available in the result cursor")
+            nrows = rowcount
+        elif nrows != -1:
+            logger.debug("row count taken from rows fetched into the table")
         else:
-            try:
-                if table_opts['tablefmt'] == self.DEFAULTS['table_opts']['tablefmt']:
-                    logger.debug(f"row count calculated from lines in the table")
-                    nrows = table.count('\n') - 1
-            except KeyError:
-                nrows = -1
-
-        if nrows == -1:
-            logger.debug(f"row count not available")
+            logger.debug("row count not available")
 
         return self.get_table_footer_text(nrows)
 
@@ -510,7 +704,7 @@ Variables
             response = self.query.text.split()[0].upper()
 
         if self.result.supports_sane_rowcount and self.result.rowcount != -1:
-            logger.debug(f"row count available in the result cursor")
+            logger.debug("row count available in the result cursor")
             response = f'{response} {self.result.rowcount}'
 
         return response
@@ -526,24 +720,118 @@ Variables
           stream.
         * If the state variable 'footer' is True, then a footer is appended to
           the result table.
+        * If the state variable 'FETCH_COUNT' is > 0, then the result set is
+          fetched and presented in batches of that many rows.  See
+          present_result_in_batches().
 
         :param table_opts: Options for rendering the tabulated result output
         :type table_opts: dict
         """
 
         table_opts = table_opts or self.get_conf_item('table_opts')
-        logger.debug(f"table_opts: {table_opts}")
+        logger.debug("table_opts: %s", table_opts)
+
+        result = self.result
 
-        if self.result:
-            if self.result.returns_rows:
-                table = tabulate(self.result, headers=self.result.keys(), **table_opts)
+        if result:
+            if result.returns_rows:
+                fetch_count = self.state.get('FETCH_COUNT', 0)
 
-                if table:
-                    table += self.get_result_table_footer(table, table_opts)
-                    self.print_data(table)
+                if fetch_count > 0:
+                    self.present_result_in_batches(fetch_count, table_opts)
+                else:
+                    rows = result.fetchall()
+                    table = tabulate(rows, headers=result.keys(), **table_opts)
+
+                    if table:
+                        table += self.get_result_table_footer(result, len(rows))
+                        self.print_data(table)
             else:
                 print(self.get_command_response())
 
+    def present_result_in_batches(self, fetch_count, table_opts):
+        """
+        Present the result set of the latest executed query in batches
+
+        Rows are fetched from self.result and tabulated fetch_count rows at a
+        time, and each batch is written out as soon as it is tabulated.  This
+        bounds the memory used for large result sets and shows the first rows
+        without waiting for the whole result set.  As each batch is tabulated
+        separately, the column widths may vary between batches.
+
+        * If the state variable 'pager' is True and stdout is a terminal, the
+          output is streamed to the system pager, if one is available.  If
+          the user quits the pager early, then the remaining rows aren't
+          fetched.  If the pager fails, then the remaining rows are written
+          to stdout.
+        * The footer row count is the number of rows written.
+
+        :param fetch_count: The number of rows to fetch in each batch
+        :type fetch_count: int
+        :param table_opts: Options for rendering the tabulated result output
+        :type table_opts: dict
+        """
+
+        pager = self.open_pager() if self.state.get('pager') and sys.stdout.isatty() else None
+        fp = pager.stdin if pager else sys.stdout
+
+        try:
+            for batch in self._tabulate_result_in_batches(fetch_count, table_opts):
+                try:
+                    fp.write(batch)
+                    fp.flush()
+                except BrokenPipeError:
+                    if not pager:
+                        raise
+
+                    # The pager has exited.  If it failed, rather than being
+                    # quit by the user, the output falls back to stdout
+                    status = self.close_pager(pager)
+                    pager = None
+
+                    if status == 0:
+                        raise
+
+                    logger.debug("pager exited with status %s, writing to stdout", status)
+                    fp = sys.stdout
+                    fp.write(batch)
+                    fp.flush()
+        except BrokenPipeError:
+            logger.debug("output closed")
+        except KeyboardInterrupt:
+            # As for pydoc, the remaining output is abandoned, but the pager
+            # is left in control of the terminal until the user quits it
+            if not pager:
+                raise
+        finally:
+            if pager:
+                self.close_pager(pager)
+
+    def _tabulate_result_in_batches(self, fetch_count, table_opts):
+        """
+        Tabulate the result set of the latest executed query in batches
+
+        :param fetch_count: The number of rows to fetch in each batch
+        :type fetch_count: int
+        :param table_opts: Options for rendering the tabulated result output
+        :type table_opts: dict
+        :returns: The output text for each batch, followed by the footer
+        :rtype: generator of str
+        """
+
+        headers = self.result.keys()
+        nrows = 0
+
+        for rows in self.result.partitions(fetch_count):
+            table = tabulate(rows, headers=headers if nrows == 0 else (), **table_opts)
+            yield table if nrows == 0 else '\n' + table
+            nrows += len(rows)
+
+        if nrows == 0:
+            yield tabulate([], headers=headers, **table_opts)
+
+        yield self.get_result_table_footer(self.result, nrows) + '\n'
+
     def prompt_for_query_params(self, raw):
         """
         Prompt for any query parameters
@@ -559,9 +847,19 @@ Variables
         """
 
         self.params = {}
-        clean = re.sub(self.get_conf_item('query_quoted_string_pattern'), '', raw)
-        keys = re.findall(self.get_conf_item('query_params_pattern'), clean)
-        logger.debug(f"parsed query parameter keys: {keys}")
+
+        # Most queries have no parameters, so we avoid scanning those at all
+        if self._query_params_marker not in raw:
+            return self.params
+
+        if self._query_scan_re:
+            group = self._query_param_group
+            keys = [m.group(group) for m in self._query_scan_re.finditer(raw) if m.group(group) is not None]
+        else:
+            clean = self._query_quoted_string_re.sub('', raw)
+            keys = self._query_params_re.findall(clean)
+
+        logger.debug("parsed query parameter keys: %s", keys)
 
         for key in keys:
             self.params[key] = input(f"{key}: ")
@@ -581,7 +879,7 @@ Variables
         """
 
         raw = raw.strip().rstrip(terminator)
-        logger.debug(f"raw stripped query: '{raw}'")
+        logger.debug("raw stripped query: '%s'", raw)
 
         return raw
 
@@ -654,6 +952,8 @@ Variables
         # MetaData.  Hence, even though it means pulling in more functionality
         # from SQLAlchemy (we have to use MetaData for table metadata), it is
         # worth it
+        from sqlalchemy import inspect
+
         insp = inspect(self.conn.engine)
         rel_names = []
 
@@ -675,6 +975,9 @@ Variables
         :rtype: sqlalchemy.schema.Table or None
         """
 
+        from sqlalchemy import MetaData, Table
+        from sqlalchemy.exc import NoSuchTableError
+
         rel_md = None
         md = MetaData()
         md.reflect(bind=self.conn.engine)
@@ -701,6 +1004,8 @@ Variables
         :rtype: str
         """
 
+        from sqlalchemy import inspect
+
         table_opts = self.get_conf_item('table_opts')
         insp = inspect(self.conn.engine)
         headers = ['Name','Type']
@@ -796,10 +1101,12 @@ Variables
         if cmd == 'begin':
             self.state['AUTOCOMMIT'] = False
 
-        self.query = text(raw)
+        self.query = _get_text_clause(raw)
         self.params = self.prompt_for_query_params(raw)
-        self.exec_query(self.query, self.params)
-        self.present_result()
+
+        # There's nothing to present if the query failed
+        if self.exec_query(self.query, self.params) is not None:
+            self.present_result()
 
         if cmd == 'rollback':
             self.state['AUTOCOMMIT'] = True
@@ -827,16 +1134,16 @@ Variables
         if raw:
             cmd = raw.split()[0]
 
-            if cmd in self.get_conf_item('repl_commands')['quit']:
+            if cmd in self._quit_cmds:
                 logger.info('quitting')
                 sys.exit(0)
-            elif cmd in self.get_conf_item('repl_commands')['state']:
+            elif cmd in self._state_cmds:
                 self.handle_state_command(raw)
-            elif cmd in self.get_conf_item('repl_commands')['metadata']:
+            elif cmd in self._metadata_cmds:
                 self.handle_metadata_command(raw)
-            elif cmd in self.get_conf_item('repl_commands')['help']:
+            elif cmd in self._help_cmds:
                 print(self.get_help(raw))
-            elif cmd in self.get_conf_item('repl_commands')['dist']:
+            elif cmd in self._dist_cmds:
                 print(self.get_dist_terms_text())
             else:
                 self.handle_query(raw)
@@ -851,7 +1158,10 @@ Variables
         """
         Readline completion callback function for the REPL
 
-        The list of possible completions are held in SQL_COMPLETIONS
+        The list of possible completions are held in self.completions, which
+        must be sorted.  Readline calls this function with an incrementing
+        state until it returns None, so the range of matching completions is
+        found once (by bisection) for a given text, when state is 0
 
         :param text: The partial input text to be completed
         :type text: str
@@ -862,31 +1172,84 @@ Variables
         """
 
         if not text:
-            matches = SQL_COMPLETIONS
-        else:
-            matches = [i for i in self.completions if i.startswith(text.lower())] + [None]
+            return SQL_COMPLETIONS[state] if state < len(SQL_COMPLETIONS) else None
+
+        if state == 0 or self._completion_range[0] != text:
+            prefix = text.lower()
+            lo = bisect.bisect_left(self.completions, prefix)
+            hi = bisect.bisect_left(self.completions, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            self._completion_range = (text, lo, hi)
+
+        _, lo, hi = self._completion_range
+
+        return self.completions[lo + state] if lo + state < hi else None
+
+    def _truncate_history_file(self, path, length):
+        """
+        Truncate the given history file to its last length entries
+
+        The history is truncated to the history length when it is written
+        on exit anyway, so doing it here means that a large history file
+        isn't read in its entirety only to be discarded
+
+        :param path: The path of the history file
+        :type path: pathlib.Path
+        :param length: The maximum number of entries to keep.  If
+        length < 0, then the history file isn't truncated
+        :type length: int
+        :raises FileNotFoundError: If the history file doesn't exist
+        """
+
+        if length < 0:
+            return
+
+        # The history file is handled as bytes, as it can contain input in
+        # any encoding.  Failing to truncate it (e.g. it's read-only) isn't
+        # fatal, the history is just read in full
+        try:
+            lines = path.read_bytes().splitlines(keepends=True)
 
-        return matches[state]
+            # A libedit history file starts with a header line that must be
+            # kept
+            header = lines[:1] if lines and lines[0].startswith(b'_HiStOrY_V2_') else []
+            entries = lines[len(header):]
+
+            if len(entries) > length:
+                logger.info("truncating history file %s to %s entries", path, length)
+                path.write_bytes(b''.join(header + entries[len(entries) - length:]))
+        except FileNotFoundError:
+            raise
+        except OSError as e:
+            logger.info("not truncating history file %s: %s", path, e)
 
     def init_repl(self):
         """
         Initialise the REPL
 
-        Any history from the configured history_file is read in.  The REPL
-        input completions are initialised
+        Any history from the configured history_file is read in, capped at
+        the configured history_length number of entries.  The REPL input
+        completions are initialised
         """
 
-        history_file = self.get_conf_item('history_file')
-        path = Path(history_file)
-
-        if not path.is_file():
-            readline.write_history_file(history_file)
+        # Readline is only needed by the interactive REPL, so it's imported
+        # here to keep the package import (and one-shot use) lightweight
+        import readline
 
-        logger.info(f"reading history from file {history_file}")
-        readline.read_history_file(history_file)
+        history_file = self.get_conf_item('history_file')
+        history_length = self.get_conf_item('history_length')
+        readline.clear_history()
+        readline.set_history_length(history_length)
 
-        logger.info(f"setting input completions")
-        self.completions = SQL_COMPLETIONS + self.get_relation_names()
+        # The history file is created when the history is written on exit
+        try:
+            self._truncate_history_file(Path(history_file), history_length)
+            logger.info("reading history from file %s", history_file)
+            readline.read_history_file(history_file)
+        except FileNotFoundError:
+            logger.info("no history file %s", history_file)
+
+        logger.info("setting input completions")
+        self.completions = sorted(SQL_COMPLETIONS + self.get_relation_names())
         readline.parse_and_bind("tab: complete")
         readline.set_completer(self.input_completions)
 
@@ -899,8 +1262,10 @@ Variables
         The session history is written to the configured history_file
         """
 
+        import readline
+
         history_file = self.get_conf_item('history_file')
-        logger.info(f"writing history to file {history_file}")
+        logger.info("writing history to file %s", history_file)
         readline.write_history_file(history_file)
 
     def repl(self):
@@ -911,10 +1276,25 @@ Variables
         the REPL on exit, and the REPL is then entered in an infinite loop.
         The user is prompted to run database queries or REPL commands,
         such as the quit command
+
+        * If stdin is not a terminal (e.g. queries are piped or redirected
+          from a file), then readline isn't set up and no history is read or
+          written.  Each line of stdin is processed in turn until EOF.
         """
 
+        # There may be no stdin at all (e.g. under pythonw), in which case
+        # there's no input to process
+        if sys.stdin is None or not sys.stdin.isatty():
+            for line in sys.stdin or ():
+                self.process_input(self.clean_raw_input(line))
+
+            return
+
         prompt = f"{self.conn.engine.url.database}=> "
         self.init_repl()
+
+        import atexit
+
         atexit.register(self.complete_repl)
 
         while True:
@@ -1,6 +1,7 @@
 import sys
 import argparse
 import logging
+import functools
 
 from squelch import Squelch, __version__, PROGNAME, DEF_CONF_FILE
 
@@ -10,12 +11,15 @@ NON_CONF_OPTS = STATE_OPTS
 logging.basicConfig()
 logger = logging.getLogger(PROGNAME)
 
-def parse_cmdln():
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     """
-    Parse the command line
+    Build the command line parser
 
-    :returns: An object containing the command line arguments and options
-    :rtype: argparse.Namespace
+    The parser is built once and reused for subsequent parses
+
+    :returns: The command line parser
+    :rtype: argparse.ArgumentParser
     """
 
     epilog = """Database Connection URL
@@ -39,7 +43,20 @@ From the SQLAlchemy documentation:
     parser.add_argument('-v', '--verbose', help='Turn verbose messaging on.  The effects of this option are incremental.', action='count', default=0)
     parser.add_argument('-V', '--version', action='version', version=f"%(prog)s {__version__}")
 
-    args = parser.parse_args()
+    return parser
+
+def parse_cmdln(argv=None):
+    """
+    Parse the command line
+
+    :param argv: The command line arguments, excluding the program name.
+    If None, then sys.argv[1:] is used
+    :type argv: list
+    :returns: An object containing the command line arguments and options
+    :rtype: argparse.Namespace
+    """
+
+    args = _build_parser().parse_args(argv)
 
     return args
 
@@ -65,68 +82,87 @@ def configure_logging(args):
         if args.verbose > 2:
             logging.getLogger().setLevel(logging.DEBUG)
 
-def update_conf_from_cmdln(conf, args):
+def partition_args(args):
     """
-    Update the configuration from command line arguments
+    Partition the command line arguments into configuration and state options
 
-    Options listed in NON_CONF_OPTS are not included in the configuration
+    Options listed in STATE_OPTS are state options.  Options listed in
+    NON_CONF_OPTS are not configuration options.  Options that weren't given
+    are not included in either
 
-    :param conf: The program's configuration
-    :type conf: dict
     :param args: The parsed command line arguments object
     :type args: argparse.Namespace object
-    :returns: The updated configuration
-    :rtype: dict
+    :returns: The configuration options and the state options
+    :rtype: tuple of (dict, dict)
     """
 
-    opts = {}
+    conf_opts = {}
+    state_opts = {}
 
     for k,v in vars(args).items():
-        if k not in NON_CONF_OPTS:
-            if v:
-                opts[k] = v
+        if v:
+            if k in STATE_OPTS:
+                state_opts[k] = v
+            elif k not in NON_CONF_OPTS:
+                conf_opts[k] = v
+
+    return conf_opts, state_opts
 
-    logger.debug(f"overriding configuration with options: {opts}")
+def update_conf_from_cmdln(conf, opts):
+    """
+    Update the configuration from command line options
+
+    :param conf: The program's configuration
+    :type conf: dict
+    :param opts: The configuration options from the command line, as
+    returned by partition_args()
+    :type opts: dict
+    :returns: The updated configuration
+    :rtype: dict
+    """
+
+    logger.debug("overriding configuration with options: %s", opts)
     conf.update(opts)
 
     return conf
 
-def set_state_from_cmdln(squelch, args, nv_sep='='):
+def set_state_from_cmdln(squelch, opts, verbose=0, nv_sep='='):
     """
-    Update the program's runtime state from command line arguments
-
-    Options listed in STATE_OPTS are used to set the program's runtime state
+    Update the program's runtime state from command line options
 
     :param squelch: The instantiated Squelch object
     :type squelch: Squelch
-    :param args: The parsed command line arguments object
-    :type args: argparse.Namespace object
+    :param opts: The state options from the command line, as returned by
+    partition_args()
+    :type opts: dict
+    :param verbose: The verbosity level.  If > 1, then an invalid state
+    option raises an exception, otherwise the program exits
+    :type verbose: int
     :param nv_sep: The name/value separator in the option argument
     :type nv_sep: str
     """
 
-    for k,v in vars(args).items():
-        if k in STATE_OPTS:
-            if v:
-                # Multiple state options can be set hence this is a list
-                for nv_pair in v:
-                    try:
-                        name, value = nv_pair.split(nv_sep, maxsplit=2)
-                    except ValueError as e:
-                        print(f"A state variable must be expressed as NAME=VALUE.  For example, --set AUTOCOMMIT=on, --pset pager=off.", file=sys.stderr)
-
-                        if args.verbose > 1:
-                            raise
-                        else:
-                            sys.exit(1)
-
-                    # Construct command in form it would be issued in client
-                    logger.debug(f"setting {name} to {value}")
-                    cmd = fr"\{k} {name} {value}"
-                    state_text = squelch.set_state(cmd)
-
-                    if state_text:
-                        logger.debug(state_text)
+    for k,v in opts.items():
+        # Multiple state options can be set hence this is a list
+        for nv_pair in v:
+            # Only the first separator splits the name from the value
+            name, sep, value = nv_pair.partition(nv_sep)
+
+            if not sep:
+                print(f"A state variable must be expressed as NAME=VALUE.  For example, --set AUTOCOMMIT=on, --pset pager=off.", file=sys.stderr)
+
+                if verbose > 1:
+                    raise ValueError(f"no '{nv_sep}' separator in state variable: {nv_pair}")
+                else:
+                    sys.exit(1)
+
+            # Construct command in form it would be issued in client
+            logger.debug("setting %s to %s", name, value)
+            cmd = fr"\{k} {name} {value}"
+            state_text = squelch.set_state(cmd)
+
+            if state_text:
+                logger.debug(state_text)
 
 def consolidate_conf(squelch, args):
     """
@@ -140,10 +176,12 @@ def consolidate_conf(squelch, args):
     :rtype: dict
     """
 
+    conf_opts, state_opts = partition_args(args)
+
     if args.conf_file:
         squelch.get_conf(file=args.conf_file)
 
-    squelch.conf = update_conf_from_cmdln(squelch.conf, args)
+    squelch.conf = update_conf_from_cmdln(squelch.conf, conf_opts)
 
     # The verbosity level may have been set in the conf file so we reconfigure
     # the logging
@@ -154,7 +192,7 @@ def consolidate_conf(squelch, args):
 
     configure_logging(args)
 
-    set_state_from_cmdln(squelch, args)
+    set_state_from_cmdln(squelch, state_opts, verbose=args.verbose)
 
     return squelch.conf
 
@@ -194,13 +232,9 @@ def main():
 
     connect(squelch, args)
 
-    # Process queries on stdin if we were called as a one-shot, otherwise
-    # we drop into the interactive REPL
-    if not sys.stdin.isatty():
-        for line in sys.stdin:
-            squelch.process_input(squelch.clean_raw_input(line))
-    else:
-        squelch.repl()
+    # If we were called as a one-shot, the REPL just processes the queries
+    # on stdin, otherwise we drop into the interactive REPL
+    squelch.repl()
 
 if __name__ == '__main__':
     main()
@@ -1,18 +1,35 @@
 import os
+import io
 import logging
 
+from types import SimpleNamespace, MappingProxyType
+from pathlib import Path
+
 import pytest
 from sqlalchemy.sql import text
 from sqlalchemy.exc import DatabaseError
 
 import squelch
 
-base = os.path.dirname(__file__)
+DATA_DIR = Path(__file__).parent / 'data'
+MIN_JSON = str(DATA_DIR / 'min.json')
+EXTRAS_JSON = str(DATA_DIR / 'extras.json')
+HISTORY_FILE = str(DATA_DIR / '.squelch_history')
 
-@pytest.fixture
+# Read-only initial states, copied into an instance's state by each test
+PAGER_ON = MappingProxyType({'pager': True})
+PAGER_OFF = MappingProxyType({'pager': False})
+FOOTER_ON = MappingProxyType({'footer': True})
+FOOTER_OFF = MappingProxyType({'footer': False})
+AUTOCOMMIT_ON = MappingProxyType({'AUTOCOMMIT': True})
+AUTOCOMMIT_OFF = MappingProxyType({'AUTOCOMMIT': False})
+
+@pytest.fixture(scope='session')
 def init_squelch():
     def _init_squelch(conf):
-        f = squelch.Squelch(conf=conf)
+        # Each instance gets its own state, so tests can't leak state changes
+        # into the module's default state
+        f = squelch.Squelch(conf=conf, state=squelch.DEF_STATE.copy())
 
         return f
 
@@ -25,22 +42,46 @@ def unconfigured_squelch(init_squelch):
 
     return f
 
+@pytest.fixture
+def readline_stubs(mocker):
+    stubs = SimpleNamespace(
+        wh=mocker.patch('readline.write_history_file'),
+        rh=mocker.patch('readline.read_history_file'),
+        ch=mocker.patch('readline.clear_history'),
+        shl=mocker.patch('readline.set_history_length'),
+        pb=mocker.patch('readline.parse_and_bind'),
+        sc=mocker.patch('readline.set_completer')
+    )
+
+    return stubs
+
+@pytest.fixture
+def mock_conn(mocker):
+    conn = mocker.patch('sqlalchemy.engine.base.Connection')
+    mocker.patch.object(conn, 'begin')
+
+    return conn
+
+@pytest.fixture
+def mock_terminal_size(mocker):
+    return mocker.patch('squelch.shutil.get_terminal_size')
+
 def test_version():
     assert squelch.__version__ == '0.3.1'
 
 @pytest.mark.parametrize(['file','expected'], [
 ('non-existent.json', {}),
-(base + '/data/min.json', {'url': 'dialect[+driver]://user:password@host/dbname'}),
-(base + '/data/extras.json', {'url': 'dialect[+driver]://user:password@host/dbname', 'verbose': 2}),
-])
+(MIN_JSON, {'url': 'dialect[+driver]://user:password@host/dbname'}),
+(EXTRAS_JSON, {'url': 'dialect[+driver]://user:password@host/dbname', 'verbose': 2}),
+], ids=['non-existent', 'min', 'extras'])
 def test_get_conf(unconfigured_squelch, file, expected):
     f = unconfigured_squelch
     f.get_conf(file=file)
     assert f.conf == expected
 
 @pytest.mark.parametrize(['file','expected'], [
-(base + '/data/min.json', {'url': 'dialect[+driver]://user:password@host/dbname'}),
-])
+(MIN_JSON, {'url': 'dialect[+driver]://user:password@host/dbname'}),
+], ids=['min'])
 def test_get_conf_debug(unconfigured_squelch, file, expected, caplog):
     caplog.set_level(logging.DEBUG)
     f = unconfigured_squelch
@@ -52,7 +93,7 @@ def test_get_conf_debug(unconfigured_squelch, file, expected, caplog):
 ({'url': 'd://u:p@h/db'}, 'url', 'd://u:p@h/db'),
 ({'url': 'd://u:p@h/db', 'verbose': 2}, 'verbose', 2),
 ({}, 'repl_commands', squelch.Squelch.DEFAULTS['repl_commands']),
-])
+], ids=['url', 'verbose', 'default'])
 def test_get_conf_item(unconfigured_squelch, conf, key, expected):
     f = unconfigured_squelch
     f.conf = conf
@@ -61,7 +102,7 @@ def test_get_conf_item(unconfigured_squelch, conf, key, expected):
 
 @pytest.mark.parametrize(['conf','key','expected'], [
 ({}, 'non-existent-key', ''),
-])
+], ids=['non-existent-key'])
 def test_get_conf_item_error(unconfigured_squelch, conf, key, expected):
     f = unconfigured_squelch
     f.conf = conf
@@ -78,40 +119,59 @@ def test_get_conf_item_error(unconfigured_squelch, conf, key, expected):
 ({'tablefmt': 'csv'}, {'tablefmt': squelch.TABLE_FORMAT_ALIASES['csv'], 'stralign': None}),
 ({'showindex': True}, {'showindex': True}),
 ({'disable_numparse': True}, {'disable_numparse': True}),
-])
+], ids=['none', 'default-format', 'html', 'aligned', 'unaligned', 'csv', 'showindex', 'disable-numparse'])
 def test_set_table_opts(unconfigured_squelch, opts, changes):
     f = unconfigured_squelch
-    expected = f.DEFAULTS['table_opts'].copy()
-    expected.update(changes)
+    expected = {**f.DEFAULTS['table_opts'], **changes}
     f.set_table_opts(**opts)
     actual = f.conf['table_opts']
     assert actual == expected
 
-@pytest.mark.parametrize(['state','key','cmd','expected'], [
-({'pager': True}, 'pager', r'\pset pager off', False),
-({'pager': False}, 'pager', r'\pset pager off', False),
-({'pager': True}, 'pager', r'\pset pager on', True),
-({'pager': False}, 'pager', r'\pset pager on', True),
-({'pager': True}, 'pager', r'\PSET PAGER OFF', False),
-({'pager': True}, 'pager', r'\PSET PAGER ON', True),
-({'pager': True}, 'pager', r'\pset pager false', False),
-({'pager': True}, 'pager', r'\pset pager 0', False),
-({'pager': False}, 'pager', r'\pset pager true', True),
-({'pager': False}, 'pager', r'\pset pager 1', True),
-({'AUTOCOMMIT': True}, 'AUTOCOMMIT', r'\set AUTOCOMMIT on', True),
-({'AUTOCOMMIT': True}, 'AUTOCOMMIT', r'\set AUTOCOMMIT off', False),
-({'AUTOCOMMIT': False}, 'AUTOCOMMIT', r'\set AUTOCOMMIT on', True),
-({'AUTOCOMMIT': True}, 'AUTOCOMMIT', r'\set autocommit off', False),
-])
+# These parameters are shared across multiple tests
+pager_state_cases = (
+pytest.param(PAGER_ON, 'pager', r'\pset pager off', False, id='pager-on-off'),
+pytest.param(PAGER_OFF, 'pager', r'\pset pager off', False, id='pager-off-off'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager on', True, id='pager-on-on'),
+pytest.param(PAGER_OFF, 'pager', r'\pset pager on', True, id='pager-off-on'),
+)
+
+@pytest.mark.parametrize(['state','key','cmd','expected'], pager_state_cases + (
+pytest.param(PAGER_ON, 'pager', r'\PSET PAGER OFF', False, id='pager-upper-off'),
+pytest.param(PAGER_ON, 'pager', r'\PSET PAGER ON', True, id='pager-upper-on'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager false', False, id='pager-false'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager 0', False, id='pager-0'),
+pytest.param(PAGER_OFF, 'pager', r'\pset pager true', True, id='pager-true'),
+pytest.param(PAGER_OFF, 'pager', r'\pset pager 1', True, id='pager-1'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager no', False, id='pager-no'),
+pytest.param(PAGER_OFF, 'pager', r'\pset pager yes', True, id='pager-yes'),
+pytest.param(PAGER_ON, 'pager', r'\pset  pager   off', False, id='pager-whitespace'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager', True, id='pager-no-value'),
+pytest.param(PAGER_ON, 'pager', r'\pset pager dummy', True, id='pager-invalid-value'),
+pytest.param(FOOTER_ON, 'footer', r'\pset footer off', False, id='footer-on-off'),
+pytest.param(FOOTER_OFF, 'footer', r'\pset footer on', True, id='footer-off-on'),
+pytest.param(FOOTER_ON, 'footer', r'\PSET FOOTER FALSE', False, id='footer-upper'),
+pytest.param({'format': 'aligned'}, 'format', r'\pset format csv', 'csv', id='format-csv'),
+pytest.param({'format': 'aligned'}, 'format', r'\pset format UNALIGNED', 'unaligned', id='format-upper'),
+pytest.param({'format': 'aligned'}, 'format', r'\pset format', 'aligned', id='format-no-value'),
+pytest.param(AUTOCOMMIT_ON, 'AUTOCOMMIT', r'\set AUTOCOMMIT on', True, id='autocommit-on-on'),
+pytest.param(AUTOCOMMIT_ON, 'AUTOCOMMIT', r'\set AUTOCOMMIT off', False, id='autocommit-on-off'),
+pytest.param(AUTOCOMMIT_OFF, 'AUTOCOMMIT', r'\set AUTOCOMMIT on', True, id='autocommit-off-on'),
+pytest.param(AUTOCOMMIT_ON, 'AUTOCOMMIT', r'\set autocommit off', False, id='autocommit-lower'),
+pytest.param({'FETCH_COUNT': 0}, 'FETCH_COUNT', r'\set FETCH_COUNT 100', 100, id='fetch-count-set'),
+pytest.param({'FETCH_COUNT': 100}, 'FETCH_COUNT', r'\set fetch_count 0', 0, id='fetch-count-unset'),
+pytest.param({'FETCH_COUNT': 100}, 'FETCH_COUNT', r'\set FETCH_COUNT off', 100, id='fetch-count-invalid'),
+pytest.param({'FETCH_COUNT': 100}, 'FETCH_COUNT', r'\set FETCH_COUNT ²', 100, id='fetch-count-non-decimal-digit'),
+))
 def test_set_state(unconfigured_squelch, state, key, cmd, expected):
     f = unconfigured_squelch
-    f.state = state
+    f.state = dict(state)
     f.set_state(cmd)
     actual = f.state[key]
     assert actual == expected
 
 @pytest.mark.parametrize(['cmd','func'], [
 ('help', 'get_help_summary_text'),
+('HELP', 'get_help_summary_text'),
 (r'\?', 'get_help_repl_cmd_text'),
 ])
 def test_get_help(unconfigured_squelch, cmd, func):
@@ -122,47 +182,47 @@ def test_get_help(unconfigured_squelch, cmd, func):
 
 @pytest.mark.parametrize(['query','params'], [
 (text('select * from data'), {}),
-])
-def test_exec_query(unconfigured_squelch, query, params, mocker, capsys):
+], ids=['select'])
+def test_exec_query(unconfigured_squelch, query, params, mock_conn, capsys):
     f = unconfigured_squelch
-    f.conn = mocker.patch('sqlalchemy.engine.base.Connection')
-    mocker.patch.object(f.conn, 'begin')
-    mocker.patch.object(f.conn, 'execute', side_effect=DatabaseError('sentinel text', {}, Exception))
+    f.conn = mock_conn
+    mock_conn.execute.side_effect = DatabaseError('sentinel text', {}, Exception)
     f.exec_query(query, params)
     captured = capsys.readouterr()
     assert 'sentinel text' in captured.err
 
 @pytest.mark.parametrize(['query','params'], [
 (text('select * from data'), {}),
-])
-def test_exec_query_debug(unconfigured_squelch, query, params, mocker, capsys, caplog):
+], ids=['select'])
+def test_exec_query_debug(unconfigured_squelch, query, params, mock_conn, capsys, caplog):
     caplog.set_level(logging.DEBUG)
     f = unconfigured_squelch
-    f.conn = mocker.patch('sqlalchemy.engine.base.Connection')
-    mocker.patch.object(f.conn, 'begin')
-    mocker.patch.object(f.conn, 'execute', side_effect=DatabaseError('sentinel text', {}, Exception))
+    f.conn = mock_conn
+    mock_conn.execute.side_effect = DatabaseError('sentinel text', {}, Exception)
     f.exec_query(query, params)
     captured = capsys.readouterr()
     assert 'sentinel text' in captured.err
     assert 'Traceback (most recent call last)' in captured.err
 
 @pytest.mark.parametrize(['data','state','kwargs','term_size','expected'], [
-('', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False),
-('short\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False),
-('short\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False),
-('short\nshort\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False),
-('short\nshort\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,4)), False),
-('short\nshort\nshort\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,4)), True),
-('short\nshort\nshort\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((5,24)), True),
-('short\nshort\nshort\nshort\n', {'pager': False}, {'sep': '\n', 'nsample': 2}, os.terminal_size((5,24)), False),
-('short\nshort\nshort\nreally long but wont be sampled\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((10,24)), False),
-('short\nreally long and will be sampled\nshort\nshort\n', {'pager': True}, {'sep': '\n', 'nsample': 2}, os.terminal_size((10,24)), True),
-('short\nshort\nshort\nreally long and will be sampled\n', {'pager': True}, {'sep': '\n', 'nsample': 5}, os.terminal_size((10,24)), False),
+pytest.param('', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False, id='empty'),
+pytest.param('short\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False, id='one-line'),
+pytest.param('short\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False, id='two-lines'),
+pytest.param('short\nshort\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,24)), False, id='three-lines'),
+pytest.param('short\nshort\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,4)), False, id='three-lines-short-term'),
+pytest.param('short\nshort\nshort\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((80,4)), True, id='four-lines-short-term'),
+pytest.param('short\nshort\nshort\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((5,24)), True, id='four-lines-narrow-term'),
+pytest.param('short\nshort\nshort\nshort\n', PAGER_OFF, {'sep': '\n', 'nsample': 2}, os.terminal_size((5,24)), False, id='pager-off'),
+pytest.param('short\nshort\nshort\nreally long but wont be sampled\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((10,24)), False, id='long-line-not-sampled'),
+pytest.param('short\nreally long and will be sampled\nshort\nshort\n', PAGER_ON, {'sep': '\n', 'nsample': 2}, os.terminal_size((10,24)), True, id='long-line-sampled'),
+pytest.param('short\nshort\nshort\nreally long and will be sampled\n', PAGER_ON, {'sep': '\n', 'nsample': 5}, os.terminal_size((10,24)), False, id='long-line-sampled-nsample-5'),
+pytest.param('short\r\nreally long and will be sampled\r\nshort\r\n', PAGER_ON, {'sep': '\r\n', 'nsample': 2}, os.terminal_size((10,24)), True, id='long-line-sampled-crlf'),
+pytest.param('short\r\nshort\r\nreally long but wont be sampled\r\n', PAGER_ON, {'sep': '\r\n', 'nsample': 2}, os.terminal_size((10,24)), False, id='long-line-not-sampled-crlf'),
 ])
-def test_use_pager(unconfigured_squelch, data, state, kwargs, term_size, expected, mocker):
+def test_use_pager(unconfigured_squelch, data, state, kwargs, term_size, expected, mock_terminal_size):
     f = unconfigured_squelch
-    f.state = state
-    mocker.patch('squelch.shutil.get_terminal_size', return_value=term_size)
+    f.state = dict(state)
+    mock_terminal_size.return_value = term_size
     actual = f.use_pager(data, **kwargs)
     assert actual == expected
 
@@ -172,18 +232,33 @@ def test_use_pager(unconfigured_squelch, data, state, kwargs, term_size, expecte
 (0, '\n(0 rows)\n'),
 (-1, '\n'),
 (-2, '\n(-2 rows)\n'),
-])
+], ids=['rows', 'one-row', 'zero-rows', 'unknown-rows', 'negative-rows'])
 def test_get_table_footer_text(unconfigured_squelch, nrows, expected):
     f = unconfigured_squelch
     actual = f.get_table_footer_text(nrows)
     assert actual == expected
 
+@pytest.mark.parametrize(['sane','rowcount','nrows','expected'], [
+(True, 3, 2, '\n(3 rows)\n'),
+(True, -1, 2, '\n(2 rows)\n'),
+(False, 3, 2, '\n(2 rows)\n'),
+(False, 3, 1, '\n(1 row)\n'),
+(False, -1, -1, '\n'),
+], ids=['sane-rowcount', 'sane-no-rowcount', 'insane-rowcount', 'insane-rowcount-one-row', 'insane-unknown-rows'])
+def test_get_result_table_footer(unconfigured_squelch, sane, rowcount, nrows, expected, mocker):
+    f = unconfigured_squelch
+    result = mocker.patch('sqlalchemy.engine.cursor.CursorResult')
+    result.supports_sane_rowcount = sane
+    result.rowcount = rowcount
+    actual = f.get_result_table_footer(result, nrows)
+    assert actual == expected
+
 @pytest.mark.parametrize(['result','headers','state','table_opts','expected'], [
-({}, [], {'pager': True}, None, ''),
-(None, [], {'pager': True}, None, ''),
-(None, [], {'pager': False}, None, ''),
-(None, ['id','title'], {'pager': False}, None, 'id'),
-(None, ['id','title'], {'pager': False}, {'tablefmt': 'plain', 'showindex': False}, 'id'),
+pytest.param({}, [], PAGER_ON, None, '', id='no-result'),
+pytest.param(None, [], PAGER_ON, None, '', id='no-headers-pager'),
+pytest.param(None, [], PAGER_OFF, None, '', id='no-headers'),
+pytest.param(None, ['id','title'], PAGER_OFF, None, 'id', id='headers'),
+pytest.param(None, ['id','title'], PAGER_OFF, {'tablefmt': 'plain', 'showindex': False}, 'id', id='headers-table-opts'),
 ])
 def test_present_result(unconfigured_squelch, result, headers, state, table_opts, expected, mocker, capsys):
     f = unconfigured_squelch
@@ -195,13 +270,13 @@ def test_present_result(unconfigured_squelch, result, headers, state, table_opts
     if result is None:
         result = mocker.patch('sqlalchemy.engine.cursor.CursorResult')
         result.returns_rows = True
-        mocker.patch.object(result, 'values', return_value=[[11,21]])
+        mocker.patch.object(result, 'fetchall', return_value=[[11,21]])
 
         if headers:
             mocker.patch.object(result, 'keys', return_value=headers)
 
     f.result = result
-    f.state = state
+    f.state = dict(state)
     f.present_result(table_opts=table_opts)
 
     if result:
@@ -212,6 +287,106 @@ def test_present_result(unconfigured_squelch, result, headers, state, table_opts
             captured = capsys.readouterr()
             assert expected in captured.out
 
+@pytest.mark.parametrize(['partitions','fetch_count','expected'], [
+([], 2, ['id', '(0 rows)']),
+([[(1,'pmb'),(2,'abc')]], 2, ['id', 'pmb', 'abc', '(2 rows)']),
+([[(1,'pmb'),(2,'abc')],[(3,'def')]], 2, ['id', 'pmb', 'abc', 'def', '(3 rows)']),
+], ids=['no-rows', 'one-batch', 'two-batches'])
+def test_present_result_in_batches(unconfigured_squelch, partitions, fetch_count, expected, mocker, capsys):
+    f = unconfigured_squelch
+    result = mocker.patch('sqlalchemy.engine.cursor.CursorResult')
+    result.returns_rows = True
+    result.supports_sane_rowcount = False
+    mocker.patch.object(result, 'keys', return_value=['id','name'])
+    p = mocker.patch.object(result, 'partitions', return_value=iter(partitions))
+    f.result = result
+    f.state = {'pager': False, 'footer': True, 'FETCH_COUNT': fetch_count}
+    f.present_result()
+    p.assert_called_once_with(fetch_count)
+    captured = capsys.readouterr()
+
+    for fragment in expected:
+        assert fragment in captured.out
+
+    assert captured.out.count('id') == 1
+
+def test_present_result_in_batches_pager(unconfigured_squelch, mocker):
+    f = unconfigured_squelch
+    result = mocker.patch('sqlalchemy.engine.cursor.CursorResult')
+    result.returns_rows = True
+    mocker.patch.object(result, 'keys', return_value=['id','name'])
+    mocker.patch.object(result, 'partitions', return_value=iter([[(1,'pmb')],[(2,'abc')]]))
+    mocker.patch('sys.stdout.isatty', return_value=True)
+    pager = mocker.patch.object(f, 'open_pager')
+    pager.return_value.stdin.write.side_effect = [None, BrokenPipeError]
+    pager.return_value.wait.return_value = 0
+    f.result = result
+    f.state = {'pager': True, 'footer': True, 'FETCH_COUNT': 1}
+    f.present_result()
+    assert pager.return_value.stdin.write.call_count == 2
+    pager.return_value.stdin.close.assert_called_once()
+    pager.return_value.wait.assert_called_once()
+
+@pytest.mark.parametrize(['env','expected'], [
+pytest.param({'PAGER': 'true'}, True, id='pager'),
+pytest.param({'MANPAGER': 'true', 'PAGER': 'no-such-pager'}, True, id='manpager-first'),
+pytest.param({'PAGER': 'no-such-pager'}, False, id='pager-not-found'),
+pytest.param({'PATH': ''}, False, id='less-not-found'),
+pytest.param({'TERM': 'dumb'}, False, id='dumb-terminal'),
+])
+def test_open_pager(unconfigured_squelch, env, expected, monkeypatch):
+    f = unconfigured_squelch
+
+    for key in ['MANPAGER', 'PAGER', 'TERM']:
+        monkeypatch.delenv(key, raising=False)
+
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+
+    pager = f.open_pager()
+
+    if expected:
+        assert pager is not None
+        assert f.close_pager(pager) == 0
+    else:
+        assert pager is None
+
+@pytest.mark.parametrize(['status','expected'], [
+# The user quit the pager, so nothing more is output
+pytest.param(0, [], id='pager-quit'),
+# The pager failed, so the output falls back to stdout
+pytest.param(3, ['id', 'pmb', 'abc', '(2 rows)'], id='pager-failed'),
+])
+def test_present_result_in_batches_pager_exit(unconfigured_squelch, status, expected, monkeypatch, mocker, capsys):
+    f = unconfigured_squelch
+    result = mocker.patch('sqlalchemy.engine.cursor.CursorResult')
+    result.returns_rows = True
+    result.supports_sane_rowcount = False
+    mocker.patch.object(result, 'keys', return_value=['id','name'])
+    mocker.patch.object(result, 'partitions', return_value=iter([[(1,'pmb')],[(2,'abc')]]))
+    mocker.patch('sys.stdout.isatty', return_value=True)
+    monkeypatch.setenv('PAGER', f"sh -c 'exit {status}'")
+    open_pager = f.open_pager
+
+    # Ensure the pager has exited before any output is written to it
+    def open_exited_pager():
+        pager = open_pager()
+        pager.wait()
+
+        return pager
+
+    mocker.patch.object(f, 'open_pager', side_effect=open_exited_pager)
+    f.result = result
+    f.state = {'pager': True, 'footer': True, 'FETCH_COUNT': 1}
+    f.present_result()
+    captured = capsys.readouterr()
+
+    for fragment in expected:
+        assert fragment in captured.out
+
+    if not expected:
+        assert captured.out == ''
+
 @pytest.mark.parametrize(['raw','values','expected'], [
 ("select * from data", [], {}),
 ("select * from data where id = :id", ['1'], {'id': '1'}),
@@ -219,15 +394,38 @@ def test_present_result(unconfigured_squelch, result, headers, state, table_opts
 # Our code filters parameter-like text within strings (the clean step).
 # Interestingly though, sqlalchemy itself will baulk on this
 ("select * from data where name = :name and status = :status and key = ':key'", ['primary','0'], {'name': 'primary', 'status': '0'}),
-])
+("select * from data where key = ':key' and name = :name", ['primary'], {'name': 'primary'}),
+("select * from data where key = 'a:b' || :key", ['0000-0000'], {'key': '0000-0000'}),
+("", [], {}),
+(":id", ['1'], {'id': '1'}),
+("select * from data where name = 'it''s :name' and status = :status", ['0'], {'status': '0'}),
+], ids=['no-params', 'one-param', 'two-params', 'param-like-in-string', 'param-after-string', 'param-after-concat', 'empty', 'param-only', 'escaped-quote-in-string'])
 def test_prompt_for_query_params(unconfigured_squelch, raw, values, expected, mocker):
     f = unconfigured_squelch
     mocker.patch('squelch.input', side_effect=values)
     f.prompt_for_query_params(raw)
     assert f.params == expected
 
-# These parameters are shared across multiple tests
-raw_input_params = pytest.mark.parametrize(['raw','expected','terminator'], [
+@pytest.mark.parametrize(['conf','raw','values','expected'], [
+({'query_params_pattern': r'@([a-z0-9_.]+)', 'query_params_marker': '@'}, "select * from data where id = @id", ['1'], {'id': '1'}),
+({'query_params_pattern': r'@([a-z0-9_.]+)', 'query_params_marker': ''}, "select * from data where id = @id", ['1'], {'id': '1'}),
+({'query_params_pattern': r'@([a-z0-9_.]+)', 'query_params_marker': '@'}, "select * from data where id = :id", [], {}),
+# Without a group, the whole match is the parameter name
+({'query_params_pattern': r':\w+'}, "select * from data where id = :id and key = ':key'", ['1'], {':id': '1'}),
+# Without a marker, an overridden pattern is always scanned
+({'query_params_pattern': r'@([a-z0-9_.]+)'}, "select * from data where id = @id", ['1'], {'id': '1'}),
+# Patterns with inline global flags are applied separately
+({'query_params_pattern': r'(?i):([a-z0-9_.]+)'}, "select * from data where id = :ID and key = ':key'", ['1'], {'ID': '1'}),
+({'query_quoted_string_pattern': r"(?s)'.+?'"}, "select * from data where id = :id and key = ':\nkey'", ['1'], {'id': '1'}),
+], ids=['custom-marker', 'empty-marker', 'default-marker-ignored', 'pattern-without-group', 'pattern-without-marker', 'params-pattern-inline-flags', 'quoted-pattern-inline-flags'])
+def test_prompt_for_query_params_conf(unconfigured_squelch, conf, raw, values, expected, mocker):
+    f = unconfigured_squelch
+    f.conf = conf
+    mocker.patch('squelch.input', side_effect=values)
+    f.prompt_for_query_params(raw)
+    assert f.params == expected
+
+@pytest.mark.parametrize(['raw','expected','terminator'], [
 ("select * from data", "select * from data", ';'),
 ("select * from data where id = :id", "select * from data where id = :id", ';'),
 ("select * from data  ", "select * from data", ';'),
@@ -237,6 +435,9 @@ raw_input_params = pytest.mark.parametrize(['raw','expected','terminator'], [
 ("  select * from data;  ", "select * from data", ';'),
 # N.B.: Spaces before a terminator won't be stripped
 ("  select * from data  ;", "select * from data  ", ';'),
+# Repeated terminators are all stripped
+("select * from data;;", "select * from data", ';'),
+("select * from data;\n", "select * from data", ';'),
 ("select * from data where id = :id;", "select * from data where id = :id", ';'),
 ("select * from data where id = :id;  ", "select * from data where id = :id", ';'),
 # Alternative terminators
@@ -244,19 +445,17 @@ raw_input_params = pytest.mark.parametrize(['raw','expected','terminator'], [
 (r"select * from data where id = :id\n/", "select * from data where id = :id", r'\n/'),
 (r"select * from data where id = :id\\", "select * from data where id = :id", r'\\'),
 ("select * from data where id = :id%", "select * from data where id = :id", '%'),
-])
-
-@raw_input_params
-def test_clean_raw_input(unconfigured_squelch, raw, expected, terminator):
+], ids=['plain', 'param', 'trailing-space', 'leading-space', 'surrounding-space', 'terminator', 'terminator-surrounding-space', 'space-before-terminator', 'repeated-terminator', 'terminator-newline', 'param-terminator', 'param-terminator-trailing-space', 'slash-terminator', 'newline-slash-terminator', 'backslash-terminator', 'percent-terminator'])
+@pytest.mark.parametrize('mode', ['direct', 'via_input'])
+def test_clean_raw_input(unconfigured_squelch, raw, expected, terminator, mode, mocker):
     f = unconfigured_squelch
-    actual = f.clean_raw_input(raw, terminator=terminator)
-    assert actual == expected
 
-@raw_input_params
-def test_prompt_for_input(unconfigured_squelch, raw, expected, terminator, mocker):
-    f = unconfigured_squelch
-    mocker.patch('squelch.input', return_value=raw)
-    actual = f.prompt_for_input(terminator=terminator)
+    if mode == 'direct':
+        actual = f.clean_raw_input(raw, terminator=terminator)
+    else:
+        mocker.patch('squelch.input', return_value=raw)
+        actual = f.prompt_for_input(terminator=terminator)
+
     assert actual == expected
 
 @pytest.mark.parametrize(['raw','query','params'], [
@@ -264,7 +463,7 @@ def test_prompt_for_input(unconfigured_squelch, raw, expected, terminator, mocke
 ("select * from data where id = :id", text("select * from data where id = :id"), {'id': '1'}),
 # Anything that's not a REPL command or blank is treated as a query
 ("0", text("0"), {}),
-])
+], ids=['select', 'select-param', 'non-command'])
 def test_process_input_query(unconfigured_squelch, raw, query, params, mocker):
     f = unconfigured_squelch
     mocker.patch.object(f, 'prompt_for_query_params', return_value=params)
@@ -323,7 +522,7 @@ def test_handle_metadata_command(unconfigured_squelch, raw, expected, mocker, ca
 ("commit", text('commit'), {}, True),
 ("select * from data", text('select * from data'), {}, True),
 ("select * from data where id = :id", text('select * from data where id = :id'), {'id': '1'}, True),
-])
+], ids=['begin', 'rollback', 'commit', 'select', 'select-param'])
 def test_handle_query(unconfigured_squelch, raw, query, params, autocommit, mocker):
     f = unconfigured_squelch
     pqp = mocker.patch.object(f, 'prompt_for_query_params', return_value=params)
@@ -338,6 +537,27 @@ def test_handle_query(unconfigured_squelch, raw, query, params, autocommit, mock
     eq.assert_called_once_with(f.query, f.params)
     pr.assert_called_once()
 
+def test_handle_query_cached(unconfigured_squelch, mocker):
+    f = unconfigured_squelch
+    mocker.patch.object(f, 'prompt_for_query_params', return_value={'id': '1'})
+    mocker.patch.object(f, 'exec_query')
+    mocker.patch.object(f, 'present_result')
+    f.handle_query("select * from data where id = :id")
+    query = f.query
+    f.handle_query("select * from data where id = :id")
+    assert f.query is query
+    f.handle_query("select * from status")
+    assert f.query is not query
+
+def test_handle_query_error(unconfigured_squelch, mocker):
+    f = unconfigured_squelch
+    mocker.patch.object(f, 'prompt_for_query_params', return_value={})
+    eq = mocker.patch.object(f, 'exec_query', return_value=None)
+    pr = mocker.patch.object(f, 'present_result')
+    f.handle_query("select * from non_existent")
+    eq.assert_called_once()
+    pr.assert_not_called()
+
 @pytest.mark.parametrize('raw', [
 (r"\q"),
 ])
@@ -350,15 +570,25 @@ def test_process_input_cmd_quit(unconfigured_squelch, raw):
     assert e.type == SystemExit
     assert e.value.code == 0
 
-@pytest.mark.parametrize(['state','key','raw','expected'], [
-({'pager': True}, 'pager', r'\pset pager off', False),
-({'pager': False}, 'pager', r'\pset pager off', False),
-({'pager': True}, 'pager', r'\pset pager on', True),
-({'pager': False}, 'pager', r'\pset pager on', True),
-])
+@pytest.mark.parametrize(['conf','raw'], [
+({'repl_commands': {'quit': [r'\quit']}}, r"\quit"),
+({'repl_commands': {'quit': [r'\q', r'\quit']}}, r"\q"),
+({'repl_commands': {'quit': [r'\quit']}}, r"\q"),
+], ids=['conf-cmd', 'conf-and-default-cmd', 'default-cmd'])
+def test_process_input_cmd_quit_conf(unconfigured_squelch, conf, raw):
+    f = unconfigured_squelch
+    f.conf = conf
+
+    with pytest.raises(SystemExit) as e:
+        f.process_input(raw)
+
+    assert e.type == SystemExit
+    assert e.value.code == 0
+
+@pytest.mark.parametrize(['state','key','raw','expected'], pager_state_cases)
 def test_process_input_cmd_state(unconfigured_squelch, state, key, raw, expected):
     f = unconfigured_squelch
-    f.state = state
+    f.state = dict(state)
     f.process_input(raw)
     actual = f.state[key]
     assert actual == expected
@@ -394,6 +624,9 @@ def test_process_input_empty(unconfigured_squelch, raw, q, mocker):
 ('cr', 0, 'create'),
 ('d', 0, 'delete'),
 ('d', 1, 'drop'),
+('d', 2, None),
+('D', 0, 'delete'),
+('', len(squelch.SQL_COMPLETIONS), None),
 ('non-existent', 0, None),
 ])
 def test_input_completions(unconfigured_squelch, text, state, expected):
@@ -401,35 +634,106 @@ def test_input_completions(unconfigured_squelch, text, state, expected):
     actual = f.input_completions(text, state)
     assert actual == expected
 
+@pytest.mark.parametrize(['text','expected'], [
+('da', ['data', 'datasets']),
+('st', ['status']),
+('s', ['select', 'status']),
+('x', []),
+], ids=['relations', 'relation', 'keyword-and-relation', 'no-match'])
+def test_input_completions_relations(unconfigured_squelch, text, expected):
+    f = unconfigured_squelch
+    f.completions = sorted(squelch.SQL_COMPLETIONS + ['status', 'datasets', 'data'])
+    actual = []
+    match = f.input_completions(text, 0)
+
+    while match is not None:
+        actual.append(match)
+        match = f.input_completions(text, len(actual))
+
+    assert actual == expected
+
 @pytest.mark.parametrize(['history_file','exists'], [
 ('non-existent-file_squelch_history', False),
-(base + '/data/.squelch_history', True),
-])
-def test_init_repl(unconfigured_squelch, history_file, exists, mocker):
+(HISTORY_FILE, True),
+], ids=['non-existent', 'exists'])
+def test_init_repl(unconfigured_squelch, history_file, exists, readline_stubs, mocker):
     f = unconfigured_squelch
     f.conf['history_file'] = history_file
     mocker.patch.object(f, 'get_relation_names', return_value=[])
-    wh = mocker.patch('readline.write_history_file')
-    rh = mocker.patch('readline.read_history_file')
-    pb = mocker.patch('readline.parse_and_bind')
-    sc = mocker.patch('readline.set_completer')
     f.init_repl()
+    readline_stubs.wh.assert_not_called()
+    readline_stubs.ch.assert_called_once()
 
-    if not exists:
-        wh.assert_called_once_with(history_file)
+    if exists:
+        readline_stubs.rh.assert_called_once_with(history_file)
+    else:
+        readline_stubs.rh.assert_not_called()
+
+    readline_stubs.pb.assert_called_once_with("tab: complete")
+    readline_stubs.sc.assert_called_once_with(f.input_completions)
+
+@pytest.mark.parametrize(['history','length','expected'], [
+(b'', 3, b''),
+(b'a\nb\n', 3, b'a\nb\n'),
+(b'a\nb\nc\nd\ne\n', 3, b'c\nd\ne\n'),
+(b'a\nb\nc\nd\ne\n', 0, b''),
+(b'a\nb\nc\nd\ne\n', -1, b'a\nb\nc\nd\ne\n'),
+(b'_HiStOrY_V2_\na\nb\nc\nd\ne\n', 3, b'_HiStOrY_V2_\nc\nd\ne\n'),
+# History can contain input that isn't valid UTF-8
+(b'a\nselect \xe9t\xe9\nb\nc\n', 3, b'select \xe9t\xe9\nb\nc\n'),
+(b'a\nselect \xe9t\xe9\n', 3, b'a\nselect \xe9t\xe9\n'),
+], ids=['empty', 'under-length', 'over-length', 'zero-length', 'unlimited-length', 'libedit-header', 'non-utf8-over-length', 'non-utf8-under-length'])
+def test_init_repl_history_length(unconfigured_squelch, history, length, expected, tmp_path, readline_stubs, mocker):
+    f = unconfigured_squelch
+    history_file = tmp_path / '.squelch_history'
+    history_file.write_bytes(history)
+    f.conf['history_file'] = str(history_file)
+    f.conf['history_length'] = length
+    mocker.patch.object(f, 'get_relation_names', return_value=[])
+    f.init_repl()
+    readline_stubs.rh.assert_called_once_with(str(history_file))
+    readline_stubs.shl.assert_called_once_with(length)
+    assert history_file.read_bytes() == expected
 
-    rh.assert_called_once_with(history_file)
-    pb.assert_called_once_with("tab: complete")
-    sc.assert_called_once_with(f.input_completions)
+def test_init_repl_history_truncate_error(unconfigured_squelch, tmp_path, readline_stubs, mocker):
+    f = unconfigured_squelch
+    history_file = tmp_path / '.squelch_history'
+    history_file.write_bytes(b'a\nb\nc\nd\ne\n')
+    f.conf['history_file'] = str(history_file)
+    f.conf['history_length'] = 3
+    mocker.patch.object(f, 'get_relation_names', return_value=[])
+
+    # A history file that can't be truncated (e.g. it's read-only) is still
+    # read in full
+    mocker.patch('squelch.Path.write_bytes', side_effect=PermissionError)
+    f.init_repl()
+    readline_stubs.rh.assert_called_once_with(str(history_file))
+    assert history_file.read_bytes() == b'a\nb\nc\nd\ne\n'
 
 @pytest.mark.parametrize('history_file', [
 ('non-existent-file_squelch_history'),
-(base + '/data/.squelch_history'),
-])
-def test_complete_repl(unconfigured_squelch, history_file, mocker):
+(HISTORY_FILE),
+], ids=['non-existent', 'exists'])
+def test_complete_repl(unconfigured_squelch, history_file, readline_stubs):
     f = unconfigured_squelch
     f.conf['history_file'] = history_file
-    wh = mocker.patch('readline.write_history_file')
     f.complete_repl()
-    wh.assert_called_once_with(history_file)
+    readline_stubs.wh.assert_called_once_with(history_file)
 
+@pytest.mark.parametrize(['stdin','expected'], [
+pytest.param("select * from data;\nselect * from status;\n", ['select * from data', 'select * from status'], id='piped'),
+pytest.param(None, [], id='no-stdin'),
+])
+def test_repl_non_interactive(init_squelch, stdin, expected, mocker):
+    # The terminal check is made when entering the REPL, so stdin can be
+    # redirected (or absent) when the Squelch object is constructed
+    mocker.patch('sys.stdin', None)
+    f = init_squelch({})
+    mocker.patch('sys.stdin', io.StringIO(stdin) if stdin is not None else None)
+    ir = mocker.patch.object(f, 'init_repl')
+    pfi = mocker.patch.object(f, 'prompt_for_input')
+    pi = mocker.patch.object(f, 'process_input')
+    f.repl()
+    ir.assert_not_called()
+    pfi.assert_not_called()
+    assert pi.call_args_list == [mocker.call(i) for i in expected]
@@ -1,18 +1,20 @@
-import os
-import sys
 import argparse
+from pathlib import Path
 
 import pytest
 
 import squelch
 import squelch.__main__ as m
 
-base = os.path.dirname(__file__)
+DATA_DIR = Path(__file__).parent / 'data'
+MIN_JSON = str(DATA_DIR / 'min.json')
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def init_squelch():
     def _init_squelch(conf):
-        f = squelch.Squelch(conf=conf)
+        # Each instance gets its own state, so tests can't leak state changes
+        # into the module's default state
+        f = squelch.Squelch(conf=conf, state=squelch.DEF_STATE.copy())
 
         return f
 
@@ -25,128 +27,135 @@ def unconfigured_squelch(init_squelch):
 
     return f
 
+@pytest.fixture
+def consolidated(unconfigured_squelch, argv):
+    f = unconfigured_squelch
+    args = m.parse_cmdln(argv[1:])
+    m.consolidate_conf(f, args)
+
+    return f, args
+
+@pytest.fixture
+def patched_connect(mocker):
+    return mocker.patch('squelch.Squelch.connect')
+
+@pytest.mark.parametrize(['argv','conf','state'], [
+pytest.param(['main'], {}, {}, id='no-args'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '-vv'], {'url': 'd://u:p@h/db', 'verbose': 2}, {}, id='url-verbose'),
+pytest.param(['main', '--set', 'AUTOCOMMIT=off'], {}, {'set': ['AUTOCOMMIT=off']}, id='set'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '--set', 'AUTOCOMMIT=off', '--pset', 'pager=off', 'footer=off'], {'url': 'd://u:p@h/db'}, {'set': ['AUTOCOMMIT=off'], 'pset': ['pager=off', 'footer=off']}, id='url-set-pset'),
+])
+def test_partition_args(argv, conf, state):
+    args = m.parse_cmdln(argv[1:])
+    conf_opts, state_opts = m.partition_args(args)
+    assert conf_opts == conf
+    assert state_opts == state
+
 @pytest.mark.parametrize(['argv','expected'], [
-(['main'], {}),
-(['main', '-u', 'd://u:p@h/db'], {'url': 'd://u:p@h/db'}),
-(['main', '-v'], {'verbose': 1}),
-(['main', '-vv'], {'verbose': 2}),
-(['main', '--set', 'foo=bar'], {}),
-(['main', '--pset', 'foo=bar'], {}),
-(['main', '-c', '/path/to/conf.json'], {'conf_file': '/path/to/conf.json'}),
-(['main', '-u', 'd://u:p@h/db', '-c', '/path/to/conf.json', '-vv'], {'url': 'd://u:p@h/db', 'conf_file': '/path/to/conf.json', 'verbose': 2}),
-(['main', '-u', 'd://u:p@h/db', '-c', '/path/to/conf.json', '-vv', '--set', 'foo=bar', '--pset', 'foo=bar'], {'url': 'd://u:p@h/db', 'conf_file': '/path/to/conf.json', 'verbose': 2}),
+pytest.param(['main'], {}, id='no-args'),
+pytest.param(['main', '-u', 'd://u:p@h/db'], {'url': 'd://u:p@h/db'}, id='url'),
+pytest.param(['main', '-v'], {'verbose': 1}, id='verbose'),
+pytest.param(['main', '-vv'], {'verbose': 2}, id='debug'),
+pytest.param(['main', '--set', 'foo=bar'], {}, id='set'),
+pytest.param(['main', '--pset', 'foo=bar'], {}, id='pset'),
+pytest.param(['main', '-c', '/path/to/conf.json'], {'conf_file': '/path/to/conf.json'}, id='conf-file'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '-c', '/path/to/conf.json', '-vv'], {'url': 'd://u:p@h/db', 'conf_file': '/path/to/conf.json', 'verbose': 2}, id='url-conf-file-debug'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '-c', '/path/to/conf.json', '-vv', '--set', 'foo=bar', '--pset', 'foo=bar'], {'url': 'd://u:p@h/db', 'conf_file': '/path/to/conf.json', 'verbose': 2}, id='url-conf-file-debug-set-pset'),
 ])
 def test_update_conf_from_cmdln(unconfigured_squelch, argv, expected):
     f = unconfigured_squelch
-    sys.argv = argv
-    args = m.parse_cmdln()
-    m.update_conf_from_cmdln(f.conf, args)
+    args = m.parse_cmdln(argv[1:])
+    conf_opts, state_opts = m.partition_args(args)
+    m.update_conf_from_cmdln(f.conf, conf_opts)
     assert f.conf == expected
 
-@pytest.mark.parametrize(['argv','changes'], [
-(['main'], {}),
-(['main', '--set', 'AUTOCOMMIT=off'], {'AUTOCOMMIT': False}),
-(['main', '--set', 'AUTOCOMMIT=on'], {'AUTOCOMMIT': True}),
-(['main', '--set', 'autocommit=off'], {'AUTOCOMMIT': False}),
-(['main', '--pset', 'pager=off'], {'pager': False}),
-(['main', '--pset', 'PAGER=ON'], {'pager': True}),
-(['main', '--pset', 'footer=false'], {'footer': False}),
-(['main', '--pset', 'footer=off', '--pset', 'pager=off'], {'footer': False, 'pager': False}),
+@pytest.mark.parametrize(['argv','expected'], [
+pytest.param(['main'], dict(squelch.DEF_STATE), id='no-args'),
+pytest.param(['main', '--set', 'AUTOCOMMIT=off'], {**squelch.DEF_STATE, 'AUTOCOMMIT': False}, id='autocommit-off'),
+pytest.param(['main', '--set', 'AUTOCOMMIT=on'], {**squelch.DEF_STATE, 'AUTOCOMMIT': True}, id='autocommit-on'),
+pytest.param(['main', '--set', 'autocommit=off'], {**squelch.DEF_STATE, 'AUTOCOMMIT': False}, id='autocommit-lower'),
+pytest.param(['main', '--pset', 'pager=off'], {**squelch.DEF_STATE, 'pager': False}, id='pager-off'),
+pytest.param(['main', '--pset', 'PAGER=ON'], {**squelch.DEF_STATE, 'pager': True}, id='pager-upper'),
+pytest.param(['main', '--pset', 'footer=false'], {**squelch.DEF_STATE, 'footer': False}, id='footer-false'),
+pytest.param(['main', '--pset', 'footer=off', '--pset', 'pager=off'], {**squelch.DEF_STATE, 'footer': False, 'pager': False}, id='footer-and-pager'),
 ])
-def test_set_state_from_cmdln(unconfigured_squelch, argv, changes):
+def test_set_state_from_cmdln(unconfigured_squelch, argv, expected):
     f = unconfigured_squelch
-    expected = f.state.copy()
-    expected.update(changes)
-    sys.argv = argv
-    args = m.parse_cmdln()
-    m.set_state_from_cmdln(f, args)
+    args = m.parse_cmdln(argv[1:])
+    conf_opts, state_opts = m.partition_args(args)
+    m.set_state_from_cmdln(f, state_opts)
     assert f.state == expected
 
 @pytest.mark.parametrize('argv', [
-(['main', '--set', 'AUTOCOMMIT']),
-(['main', '--set', 'AUTOCOMMIT off']),
-(['main', '--set', 'AUTOCOMMIT,on']),
-(['main', '--set', 'autocommit:off', '-v']),
-(['main', '--set', 'autocommit:off', '-vv']),
-(['main', '--pset', 'pager']),
-(['main', '--pset', 'pager off']),
-(['main', '--pset', 'PAGER,ON']),
-(['main', '--pset', 'footer:false', '-v']),
-(['main', '--pset', 'footer:false', '-vv']),
+pytest.param(['main', '--set', 'AUTOCOMMIT'], id='set-no-value'),
+pytest.param(['main', '--set', 'AUTOCOMMIT off'], id='set-space-sep'),
+pytest.param(['main', '--set', 'AUTOCOMMIT,on'], id='set-comma-sep'),
+pytest.param(['main', '--set', 'autocommit:off', '-v'], id='set-colon-sep-verbose'),
+pytest.param(['main', '--set', 'autocommit:off', '-vv'], id='set-colon-sep-debug'),
+pytest.param(['main', '--pset', 'pager'], id='pset-no-value'),
+pytest.param(['main', '--pset', 'pager off'], id='pset-space-sep'),
+pytest.param(['main', '--pset', 'PAGER,ON'], id='pset-comma-sep'),
+pytest.param(['main', '--pset', 'footer:false', '-v'], id='pset-colon-sep-verbose'),
+pytest.param(['main', '--pset', 'footer:false', '-vv'], id='pset-colon-sep-debug'),
 ])
 def test_set_state_from_cmdln_error(unconfigured_squelch, argv):
     f = unconfigured_squelch
-    sys.argv = argv
-    args = m.parse_cmdln()
+    args = m.parse_cmdln(argv[1:])
+    conf_opts, state_opts = m.partition_args(args)
 
     # In DEBUG mode, we raise the exception for the full stack trace,
     # otherwise we just show a focussed error message and exit with non-zero
     if args.verbose > 1:
         with pytest.raises(ValueError) as e:
-            m.set_state_from_cmdln(f, args)
+            m.set_state_from_cmdln(f, state_opts, verbose=args.verbose)
     else:
         with pytest.raises(SystemExit) as e:
-            m.set_state_from_cmdln(f, args)
+            m.set_state_from_cmdln(f, state_opts, verbose=args.verbose)
 
         assert e.type == SystemExit
         assert e.value.code == 1
 
-@pytest.mark.parametrize(['argv','expected'], [
-(['main'], {}),
-(['main', '-u', 'd://u:p@h/db'], {'url': 'd://u:p@h/db'}),
-(['main', '-v'], {'verbose': 1}),
-(['main', '-vv'], {'verbose': 2}),
-(['main', '-c', base + '/data/min.json'], {'conf_file': base + '/data/min.json', 'url': 'dialect[+driver]://user:password@host/dbname'}),
-(['main', '-c', base + '/data/min.json', '-v'], {'conf_file': base + '/data/min.json', 'url': 'dialect[+driver]://user:password@host/dbname', 'verbose': 1}),
+# These parameters are shared across multiple tests.  The first resolve to a
+# database connection URL, the second don't
+url_argv_cases = (
+pytest.param(['main', '-u', 'd://u:p@h/db'], {'url': 'd://u:p@h/db'}, id='url'),
+pytest.param(['main', '-c', MIN_JSON], {'conf_file': MIN_JSON, 'url': 'dialect[+driver]://user:password@host/dbname'}, id='conf-file'),
+pytest.param(['main', '-c', MIN_JSON, '-v'], {'conf_file': MIN_JSON, 'url': 'dialect[+driver]://user:password@host/dbname', 'verbose': 1}, id='conf-file-verbose'),
 # URL on command line will override one from conf file
-(['main', '-u', 'd://u:p@h/db', '-c', base + '/data/min.json', '-v'], {'conf_file': base + '/data/min.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
-(['main', '-c', base + '/data/min.json', '-u', 'd://u:p@h/db', '-v'], {'conf_file': base + '/data/min.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
+pytest.param(['main', '-u', 'd://u:p@h/db', '-c', MIN_JSON, '-v'], {'conf_file': MIN_JSON, 'url': 'd://u:p@h/db', 'verbose': 1}, id='url-before-conf-file'),
+pytest.param(['main', '-c', MIN_JSON, '-u', 'd://u:p@h/db', '-v'], {'conf_file': MIN_JSON, 'url': 'd://u:p@h/db', 'verbose': 1}, id='url-after-conf-file'),
+# Non-existent conf file
+pytest.param(['main', '-c', '/non-existent.json', '-u', 'd://u:p@h/db', '-v'], {'conf_file': '/non-existent.json', 'url': 'd://u:p@h/db', 'verbose': 1}, id='non-existent-conf-file-url'),
+)
+no_url_argv_cases = (
+pytest.param(['main'], {}, id='no-args'),
+pytest.param(['main', '-v'], {'verbose': 1}, id='verbose'),
+pytest.param(['main', '-vv'], {'verbose': 2}, id='debug'),
 # Non-existent conf file
-(['main', '-c', '/non-existent.json'], {'conf_file': '/non-existent.json'}),
-(['main', '-c', '/non-existent.json', '-u', 'd://u:p@h/db', '-v'], {'conf_file': '/non-existent.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
-(['main', '-c', '/non-existent.json', '-v'], {'conf_file': '/non-existent.json', 'verbose': 1}),
+pytest.param(['main', '-c', '/non-existent.json'], {'conf_file': '/non-existent.json'}, id='non-existent-conf-file'),
+pytest.param(['main', '-c', '/non-existent.json', '-v'], {'conf_file': '/non-existent.json', 'verbose': 1}, id='non-existent-conf-file-verbose'),
+)
+
+@pytest.mark.parametrize(['argv','expected'], url_argv_cases + no_url_argv_cases + (
 # State variables shouldn't appear in the configuration file
-(['main', '-u', 'd://u:p@h/db', '--set', 'AUTOCOMMIT=off'], {'url': 'd://u:p@h/db'}),
-(['main', '-u', 'd://u:p@h/db', '--pset', 'pager=off'], {'url': 'd://u:p@h/db'}),
-(['main', '-u', 'd://u:p@h/db', '--set', 'AUTOCOMMIT=off', '--pset', 'pager=off'], {'url': 'd://u:p@h/db'}),
-])
-def test_consolidate_conf(unconfigured_squelch, argv, expected):
-    f = unconfigured_squelch
-    sys.argv = argv
-    args = m.parse_cmdln()
-    m.consolidate_conf(f, args)
+pytest.param(['main', '-u', 'd://u:p@h/db', '--set', 'AUTOCOMMIT=off'], {'url': 'd://u:p@h/db'}, id='url-set'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '--pset', 'pager=off'], {'url': 'd://u:p@h/db'}, id='url-pset'),
+pytest.param(['main', '-u', 'd://u:p@h/db', '--set', 'AUTOCOMMIT=off', '--pset', 'pager=off'], {'url': 'd://u:p@h/db'}, id='url-set-pset'),
+))
+def test_consolidate_conf(consolidated, expected):
+    f, args = consolidated
     assert f.conf == expected
 
-@pytest.mark.parametrize(['argv','expected'], [
-(['main', '-u', 'd://u:p@h/db'], {'url': 'd://u:p@h/db'}),
-(['main', '-c', base + '/data/min.json'], {'conf_file': base + '/data/min.json', 'url': 'dialect[+driver]://user:password@host/dbname'}),
-(['main', '-c', base + '/data/min.json', '-v'], {'conf_file': base + '/data/min.json', 'url': 'dialect[+driver]://user:password@host/dbname', 'verbose': 1}),
-(['main', '-u', 'd://u:p@h/db', '-c', base + '/data/min.json', '-v'], {'conf_file': base + '/data/min.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
-(['main', '-c', base + '/data/min.json', '-u', 'd://u:p@h/db', '-v'], {'conf_file': base + '/data/min.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
-(['main', '-c', '/non-existent.json', '-u', 'd://u:p@h/db', '-v'], {'conf_file': '/non-existent.json', 'url': 'd://u:p@h/db', 'verbose': 1}),
-])
-def test_connect(unconfigured_squelch, argv, expected, mocker):
-    f = unconfigured_squelch
-    sys.argv = argv
-    args = m.parse_cmdln()
-    m.consolidate_conf(f, args)
-    mocker.patch('squelch.Squelch.connect')
+@pytest.mark.parametrize(['argv','expected'], url_argv_cases)
+def test_connect(consolidated, expected, patched_connect):
+    f, args = consolidated
     m.connect(f, args)
+    patched_connect.assert_called_once_with(expected['url'])
     assert f.conf == expected
 
-@pytest.mark.parametrize(['argv','expected'], [
-(['main'], {}),
-(['main', '-v'], {'verbose': 1}),
-(['main', '-vv'], {'verbose': 2}),
-(['main', '-c', '/non-existent.json'], {'conf_file': '/non-existent.json'}),
-(['main', '-c', '/non-existent.json', '-v'], {'conf_file': '/non-existent.json', 'verbose': 1}),
-])
-def test_connect_error(unconfigured_squelch, argv, expected, mocker):
-    f = unconfigured_squelch
-    sys.argv = argv
-    args = m.parse_cmdln()
-    m.consolidate_conf(f, args)
-    mocker.patch('squelch.Squelch.connect')
+@pytest.mark.parametrize(['argv','expected'], no_url_argv_cases)
+def test_connect_error(consolidated, expected, patched_connect):
+    f, args = consolidated
 
     # In DEBUG mode, we raise the exception for the full stack trace,
     # otherwise we just show a focussed error message and exit with non-zero
@@ -163,3 +172,4 @@ def test_connect_error(unconfigured_squelch, argv, expected, mocker):
         assert e.value.code == 1
         assert f.conf == expected
 
+    patched_connect.assert_not_called()